@@ -0,0 +1,80 @@
+"""Guard the startup time of the ``twitlog`` command.
+
+Runs a few cheap invocations in fresh interpreters, failing if any of them
+is slower than ``--max-ms`` (median), or if merely loading a subcommand
+drags in the modules we only want imported once there is real work to do.
+
+    python bench/startup.py [--runs N] [--max-ms MS]
+
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+
+here = os.path.dirname(os.path.abspath(__file__))
+root = os.path.dirname(here)
+
+invocations = [
+    ['--help'],
+    ['analytics', '--help'],
+    ['archive', '--help'],
+    ['audience', '--help'],
+    ['feed', '--help'],
+    ['followers', '--help'],
+    ['reprocess', '--help'],
+    ['retention', '--help'],
+    ['serve', '--help'],
+]
+
+heavy_modules = ['requests', 'requests_oauthlib', 'sqlite3']
+
+import_check = '''
+import sys
+from twitlog.main import commands, load
+for name in sorted(commands):
+    load(name)()
+print ' '.join(m for m in %r if m in sys.modules)
+''' % (heavy_modules, )
+
+
+def time_invocation(args, runs):
+    env = dict(os.environ, PYTHONPATH=root)
+    times = []
+    with open(os.devnull, 'w') as devnull:
+        for _ in xrange(runs):
+            start = time.time()
+            subprocess.check_call([sys.executable, '-m', 'twitlog'] + args, stdout=devnull, env=env)
+            times.append(1000 * (time.time() - start))
+    times.sort()
+    return times[len(times) // 2]
+
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--runs', type=int, default=11)
+    parser.add_argument('--max-ms', type=float, default=100)
+    args = parser.parse_args()
+
+    failed = False
+
+    loaded = subprocess.check_output([sys.executable, '-c', import_check], env=dict(os.environ, PYTHONPATH=root)).split()
+    if loaded:
+        print 'FAIL loading commands imported: %s' % ', '.join(loaded)
+        failed = True
+
+    for argv in invocations:
+        median = time_invocation(argv, args.runs)
+        ok = median <= args.max_ms
+        failed = failed or not ok
+        print '%s %6.1fms twitlog %s' % ('ok  ' if ok else 'FAIL', median, ' '.join(argv))
+
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -5,5 +5,7 @@ here="$(cd "$(dirname "${BASH_SOURCE[0]}")"; pwd)"
 source venv/bin/activate
 source .env.sh
 
-twitlog-followers
-twitlog-analytics
+twitlog followers
+twitlog analytics
+twitlog retention
+twitlog archive
@@ -5,8 +5,10 @@ setup(
     packages=find_packages('.'),
     entry_points={
         'console_scripts': '''
+            twitlog = twitlog.main:main
             twitlog-analytics = twitlog.analytics:AnalyticsCommand.make_and_run
             twitlog-followers = twitlog.followers:FollowersCommand.make_and_run
+            twitlog-retention = twitlog.retention:RetentionCommand.make_and_run
         ''',
     },
 )
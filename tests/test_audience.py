@@ -0,0 +1,88 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from StringIO import StringIO
+
+from twitlog.audience import AudienceCommand, Evaluator, decode_ids, encode_ids, save_audience
+from twitlog.database import Database
+
+
+class TestEncoding(unittest.TestCase):
+
+    def test_roundtrip(self):
+        for ids in [], [1], [5, 3, 3, 2 ** 62 + 7, 1000, 2 ** 40]:
+            self.assertEqual(list(decode_ids(encode_ids(ids))), sorted(set(ids)))
+
+
+class TestEvaluator(unittest.TestCase):
+
+    audiences = {
+        (None, 'followers', None): [1, 2, 3, 4],
+        (None, 'followers', '2016-01-01 23:59:59'): [1, 2],
+        (None, 'friends', None): [3, 4, 5],
+        ('other', 'followers', '2016-01-01 12:00:00'): [2, 5, 6],
+    }
+
+    def evaluate(self, expr):
+        return sorted(Evaluator(lambda *key: self.audiences[key]).evaluate(expr))
+
+    def test_operators(self):
+        self.assertEqual(self.evaluate('followers | friends'), [1, 2, 3, 4, 5])
+        self.assertEqual(self.evaluate('followers & friends'), [3, 4])
+        self.assertEqual(self.evaluate('followers - friends'), [1, 2])
+        self.assertEqual(self.evaluate('followers ^ friends'), [1, 2, 5])
+
+    def test_operands(self):
+        self.assertEqual(self.evaluate('followers - followers@2016-01-01'), [3, 4])
+        self.assertEqual(self.evaluate('other:followers@2016-01-01T12:00:00'), [2, 5, 6])
+
+    def test_grouping(self):
+        # Left to right, unless grouped.
+        self.assertEqual(self.evaluate('followers - friends | other:followers@2016-01-01T12:00:00'), [1, 2, 5, 6])
+        self.assertEqual(self.evaluate('followers - (friends | other:followers@2016-01-01T12:00:00)'), [1])
+
+    def test_errors(self):
+        for expr in 'followers -', '(followers', 'followers)', 'followers & bogus', '| friends':
+            self.assertRaises(ValueError, self.evaluate, expr)
+
+
+class TestAudienceCommand(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.db = Database(os.path.join(self.dir, 'test.sqlite'))
+        self.db.create()
+        con = self.db.connect()
+        with con:
+            save_audience(con, 'followers', [3, 1, 2])
+            save_audience(con, 'friends', [2, 4])
+        con.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def run_command(self, *argv):
+        cmd = AudienceCommand(prog='audience')
+        cmd._db = self.db
+        stdout, stderr = sys.stdout, sys.stderr
+        sys.stdout = sys.stderr = out = StringIO()
+        try:
+            cmd.run(['--username', 'test'] + list(argv))
+        finally:
+            sys.stdout, sys.stderr = stdout, stderr
+        return out.getvalue()
+
+    def test_output(self):
+        self.assertEqual(self.run_command('followers'), '3\n')
+        self.assertEqual(self.run_command('followers - friends'), '2\n')
+        self.assertEqual(self.run_command('--ids', 'followers ^ friends'), '1\n3\n4\n')
+
+    def test_errors(self):
+        for expr in 'followers@2000-01-01', 'followers -', 'nobody:friends':
+            self.assertRaises(SystemExit, self.run_command, expr)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from twitlog.database import Database
+
+
+class TestTableRebuild(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.db = Database(os.path.join(self.dir, 'test.sqlite'))
+        self.db.create()
+        self.con = self.db.connect()
+
+    def tearDown(self):
+        self.con.close()
+        shutil.rmtree(self.dir)
+
+    def test_drop_column(self):
+        with self.con:
+            self.con.execute('CREATE TABLE things (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT UNIQUE, junk TEXT)')
+            self.con.execute('CREATE INDEX things_name ON things (name)')
+            # Sparse ids, as Twitter's are.
+            for i in xrange(25):
+                self.con.insert('things', {'id': i * 10 ** 12 + 1, 'name': 'n%d' % i, 'junk': 'x'})
+
+        progress = []
+        self.con.rebuild_table('things', drop=['junk'], chunk_size=7, progress=lambda done, total: progress.append((done, total)))
+
+        self.assertEqual(self.con.columns('things'), ['id', 'name'])
+        self.assertEqual(
+            [tuple(row) for row in self.con.execute('SELECT id, name FROM things ORDER BY id')],
+            [(i * 10 ** 12 + 1, 'n%d' % i) for i in xrange(25)],
+        )
+        self.assertEqual(progress[-1], (25, 25))
+
+        indexes = set(row['name'] for row in self.con.execute('PRAGMA index_list(things)'))
+        self.assertIn('things_name', indexes)
+        with self.con:
+            self.assertRaises(Exception, self.con.insert, 'things', {'name': 'n3'})
+        with self.con:
+            new_id = self.con.insert('things', {'name': 'new'})
+        self.assertGreater(new_id, 24 * 10 ** 12 + 1)
+
+    def test_refuses_check(self):
+        with self.con:
+            self.con.execute('CREATE TABLE checked (id INTEGER PRIMARY KEY, a INT CHECK (a > 0), b TEXT)')
+        self.assertRaises(ValueError, self.con.drop_column, 'checked', 'b')
+        self.assertEqual(self.con.columns('checked'), ['id', 'a', 'b'])
+
+    def test_refuses_transaction(self):
+        with self.con:
+            self.con.execute('CREATE TABLE things (id INTEGER PRIMARY KEY, a TEXT, b TEXT)')
+        with self.con:
+            self.assertRaises(RuntimeError, self.con.drop_column, 'things', 'b')
+        self.assertEqual(self.con.columns('things'), ['id', 'a', 'b'])
+
+    def test_refuses_trigger_on_dropped_column(self):
+        with self.con:
+            self.con.execute('CREATE TABLE things (id INTEGER PRIMARY KEY, a TEXT, b TEXT)')
+            self.con.execute('CREATE TABLE log (value TEXT)')
+            self.con.execute('''CREATE TRIGGER things_log AFTER INSERT ON things BEGIN
+                INSERT INTO log (value) VALUES (NEW.b);
+            END''')
+        self.assertRaises(ValueError, self.con.drop_column, 'things', 'b')
+        self.assertEqual(self.con.columns('things'), ['id', 'a', 'b'])
+
+        # Triggers which don't use it come along.
+        self.con.drop_column('things', 'a')
+        with self.con:
+            self.con.insert('things', {'b': 'x'})
+        self.assertEqual(self.con.execute('SELECT value FROM log').fetchall()[0][0], 'x')
+
+    def test_rerun_after_interruption(self):
+        from twitlog.database.rebuild import TableRebuild
+        with self.con:
+            self.con.execute('CREATE TABLE things (id INTEGER PRIMARY KEY, a TEXT, b TEXT)')
+            self.con.insert('things', {'a': 'x', 'b': 'y'})
+
+        # As left by a rebuild killed while copying.
+        rebuild = TableRebuild(self.con, 'things', drop=['b'])
+        with self.con:
+            self.con.execute(rebuild.create_sql(rebuild.new_name))
+            for sql in rebuild.trigger_sql():
+                self.con.execute(sql)
+
+        self.con.drop_column('things', 'b')
+        with self.con:
+            self.con.insert('things', {'a': 'z'})
+        self.assertEqual([row[0] for row in self.con.execute('SELECT a FROM things ORDER BY id')], ['x', 'z'])
+        self.assertEqual(self.con.execute("SELECT count(*) FROM sqlite_master WHERE name LIKE '_rebuild_%'").fetchone()[0], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from twitlog.database import Database
+from twitlog.retention import RetentionCommand
+
+
+class TestRetention(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.db = Database(os.path.join(self.dir, 'test.sqlite'))
+        self.db.create()
+        self.con = self.db.connect()
+        self.cmd = RetentionCommand(prog='retention')
+        self.cmd.args = self.cmd.parser.parse_args(['--username', 'test', '--chunk-size', '5'])
+        self.cmd._db = self.db
+
+    def tearDown(self):
+        self.con.close()
+        shutil.rmtree(self.dir)
+
+    def add_profile(self, user_id, ago):
+        created_at = self.con.execute("SELECT datetime('now', ?)", ['-%d hours' % ago]).fetchone()[0]
+        return self.con.insert('user_profiles', {'user_id': user_id, 'json': '{}', 'created_at': created_at})
+
+    def test_bucket_sql(self):
+        sql = self.cmd.bucket_sql('x', [('2016-02-01', 'day'), ('2016-01-01', 'month')])
+        rows = [
+            ('2016-02-05 12:00:00', None),
+            ('2016-01-20 12:00:00', '0 2016-01-20'),
+            ('2015-12-20 12:00:00', '1 2015-12'),
+        ]
+        for created_at, expected in rows:
+            actual = self.con.execute('SELECT %s FROM (SELECT ? AS created_at) AS x' % sql, [created_at]).fetchone()[0]
+            self.assertEqual(actual, expected)
+
+    def test_downsample(self):
+        with self.con:
+            self.con.insert('users', {'id': 1})
+            self.con.insert('users', {'id': 2})
+            # Four a day for two weeks, newest first.
+            for hours in xrange(14 * 24 - 1, -1, -6):
+                self.add_profile(1, hours)
+            # The pointer keeps an otherwise redundant snapshot.
+            pinned = self.add_profile(2, 12 * 24 + 1)
+            self.add_profile(2, 12 * 24)
+            self.con.update('users', {'last_profile_id': pinned}, {'id': 2})
+
+        cutoff = self.con.execute("SELECT datetime('now', '-7 days')").fetchone()[0]
+        last_per_day = set(row[0] for row in self.con.execute('SELECT max(id) FROM user_profiles WHERE user_id = 1 AND created_at < ? GROUP BY date(created_at)', [cutoff]))
+        recent = self.con.execute('SELECT count(*) FROM user_profiles WHERE user_id = 1 AND created_at >= ?', [cutoff]).fetchone()[0]
+
+        self.cmd.downsample('user_profiles')
+
+        # The last of each day past the cutoff, and everything since.
+        self.assertEqual(set(row[0] for row in self.con.execute('SELECT id FROM user_profiles WHERE user_id = 1 AND created_at < ?', [cutoff])), last_per_day)
+        self.assertEqual(self.con.execute('SELECT count(*) FROM user_profiles WHERE user_id = 1 AND created_at >= ?', [cutoff]).fetchone()[0], recent)
+
+        self.assertEqual(self.con.execute('SELECT count(*) FROM user_profiles WHERE user_id = 2').fetchone()[0], 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,12 +1,30 @@
+import datetime
 import json
 import os
-
-from requests import Session
-from BeautifulSoup import BeautifulSoup
+import re
 
 from .cli import BaseCommand
 
 
+_token_input_re = re.compile(r'''<input\b[^>]*\bname=["']authenticity_token["'][^>]*>''', re.I)
+_token_value_re = re.compile(r'''\bvalue=["']([^"']*)["']''', re.I)
+
+
+def scan_for_token(chunks, overlap=4096):
+    # Stop as soon as we find the token, rather than downloading and parsing
+    # the whole page. We keep a tail of each chunk around in case the tag
+    # is split between them.
+    buf = ''
+    for chunk in chunks:
+        buf += chunk
+        m = _token_input_re.search(buf)
+        if m:
+            value = _token_value_re.search(m.group(0))
+            if value:
+                return value.group(1)
+        buf = buf[-overlap:]
+
+
 class AnalyticsCommand(BaseCommand):
 
     def add_arguments(self):
@@ -20,78 +38,152 @@ class AnalyticsCommand(BaseCommand):
             self.update_analytics()
 
     def update_tweets(self):
-        with self.db.connect() as con:
-            params = {
-                'screen_name': self.args.username,
-                'trim_user': 'true', # We don't need full user objects
-                'count': '200',
-                'include_rts': 'false', # We don't want retweets
-            }
+
+        params = {
+            'screen_name': self.args.username,
+            'trim_user': 'true', # We don't need full user objects
+            'count': '200',
+            'include_rts': 'false', # We don't want retweets
+        }
+        con = self.db.connect(readonly=True)
+        try:
             row = con.execute('SELECT max(id) FROM tweets').fetchone()
-            if row:
-                params['since_id'] = row[0]
+        finally:
+            con.close()
+        if row:
+            params['since_id'] = row[0]
+
+        tweets = self.oath.get_json('statuses/user_timeline', params=params)
 
-            for tweet in self.oath.get_json('statuses/user_timeline', params=params):
+        with self.db.connect() as con:
+            for tweet in tweets:
                 con.insert('tweets', {
                     'id': tweet['id'],
                     'json': json.dumps(tweet, sort_keys=True),
                 })
+            if tweets:
+                con.bump_generation()
 
     def update_analytics(self):
 
+        session = self.get_web_session()
+
+        # Nothing is held open while we're waiting on twitter.com; the scan
+        # reads a page at a time, and each change is its own transaction.
+        con = self.db.connect()
+        for tid, old_json in self.db.scan('''
+            SELECT tweet.id, last.json
+            FROM tweets as tweet
+            LEFT JOIN tweet_metrics as last
+            ON tweet.last_metrics_id = last.id
+            WHERE tweet.last_metrics_id IS NULL OR
+                last.created_at > datetime('now','-1 day')
+        ''', descending=True, chunk_size=100):
+            res = session.get('https://twitter.com/i/tfb/v1/tweet_activity/web/poll/%s' % tid)
+            new_metrics = {k: int(v) for k, v in res.json()['metrics']['all'].iteritems()}
+            new_metrics.pop('Engagements', None) # Just a total of the others.
+            new_json = json.dumps(new_metrics, sort_keys=True)
+            changed = new_json != old_json
+            print tid, new_json if changed else 'unchanged'
+            if changed:
+                with con:
+                    mid = con.insert('tweet_metrics', {
+                        'tweet_id': tid,
+                        'json': new_json,
+                    })
+                    con.update('tweets', {'last_metrics_id': mid}, {'id': tid})
+                    con.add_event('metrics', tid, {
+                        'metrics_id': mid,
+                        'metrics': new_metrics,
+                    })
+                    con.bump_generation()
+
+    def get_web_session(self):
+
+        # These are slow to import, and most runs don't need them.
+        from requests import Session
+
         session = Session()
 
         if 'TWITLOG_COOKIES' in os.environ:
             cookies = json.loads(os.environ['TWITLOG_COOKIES'])
             session.cookies.update(cookies)
+            return session
 
-        else:
-
-            print 'Fetching homepage for auth token'
-            res = session.get('https://twitter.com')
-
-            body = BeautifulSoup(res.text)
-            input_ = body.find(lambda tag: tag.name == 'input' and tag.get('name') == 'authenticity_token')
-            authe_token = input_['value']
-
-
-            print 'Logging into account'
-            res = session.post('https://twitter.com/sessions', data={
-                'session[username_or_email]': self.args.username,
-                'session[password]': self.args.password,
-                'return_to_ssl': 'true',
-                'scribe_log': '',
-                'redirect_after_login': '/',
-                'authenticity_token': authe_token,
+        with self.db.connect() as con:
+            row = con.execute('''
+                SELECT id, cookies FROM web_sessions
+                WHERE expires_at IS NULL OR expires_at > datetime('now')
+                ORDER BY id DESC LIMIT 1
+            ''').fetchone()
+
+        if row:
+            for cookie in json.loads(row['cookies']):
+                session.cookies.set(**cookie)
+            if self.validate_web_session(session):
+                print 'Reusing cached session'
+                with self.db.connect() as con:
+                    con.update('web_sessions', {'validated_at': datetime.datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')}, {'id': row['id']})
+                return session
+            print 'Cached session is no longer valid'
+            session.cookies.clear()
+
+        self.login_web_session(session)
+        if not self.validate_web_session(session):
+            raise RuntimeError('could not log into twitter.com')
+        self.save_web_session(session)
+        return session
+
+    def validate_web_session(self, session):
+        # Logged out requests get redirected to the login page; don't bother
+        # reading the body either way.
+        res = session.get('https://twitter.com/settings/account', allow_redirects=False, stream=True)
+        res.close()
+        return res.status_code == 200
+
+    def login_web_session(self, session):
+
+        print 'Fetching homepage for auth token'
+        res = session.get('https://twitter.com', stream=True)
+        try:
+            authe_token = scan_for_token(res.iter_content(8192))
+        finally:
+            res.close()
+        if not authe_token:
+            raise ValueError('could not find authenticity_token')
+
+        print 'Logging into account'
+        res = session.post('https://twitter.com/sessions', data={
+            'session[username_or_email]': self.args.username,
+            'session[password]': self.args.password,
+            'return_to_ssl': 'true',
+            'scribe_log': '',
+            'redirect_after_login': '/',
+            'authenticity_token': authe_token,
+        }, stream=True)
+        res.close()
+
+    def save_web_session(self, session):
+
+        cookies = []
+        expires_at = None
+        for cookie in session.cookies:
+            cookies.append({
+                'name': cookie.name,
+                'value': cookie.value,
+                'domain': cookie.domain,
+                'path': cookie.path,
+                'expires': cookie.expires,
+                'secure': cookie.secure,
             })
+            # The session lives exactly as long as its auth cookie.
+            if cookie.name == 'auth_token' and cookie.expires:
+                expires_at = datetime.datetime.utcfromtimestamp(cookie.expires).strftime('%Y-%m-%d %H:%M:%S')
 
-            cookies = dict(session.cookies.iteritems())
-            print
-            print 'export TWITLOG_COOKIES=\'%s\'' % json.dumps(cookies)
-            print
-
+        now = datetime.datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
         with self.db.connect() as con:
-            for tid, old_json in con.execute('''
-                SELECT tweet.id, last.json
-                FROM tweets as tweet
-                LEFT JOIN tweet_metrics as last
-                ON tweet.last_metrics_id = last.id
-                WHERE tweet.last_metrics_id IS NULL OR
-                    last.created_at > datetime('now','-1 day')
-                ORDER BY tweet.id DESC
-            '''):
-                res = session.get('https://twitter.com/i/tfb/v1/tweet_activity/web/poll/%s' % tid)
-                new_metrics = {k: int(v) for k, v in res.json()['metrics']['all'].iteritems()}
-                new_metrics.pop('Engagements', None) # Just a total of the others.
-                new_json = json.dumps(new_metrics, sort_keys=True)
-                changed = new_json != old_json
-                print tid, new_json if changed else 'unchanged'
-                if changed:
-                    mid = con.insert('tweet_metrics', {
-                        'tweet_id': tid,
-                        'json': new_json,
-                    })
-                    con.update('tweets', {'last_metrics_id': mid}, {'id': tid})
-                    con.commit()
-
-
+            con.insert('web_sessions', {
+                'cookies': json.dumps(cookies, sort_keys=True),
+                'expires_at': expires_at,
+                'validated_at': now,
+            })
@@ -0,0 +1,123 @@
+from .cli import BaseCommand
+
+
+class ArchiveCommand(BaseCommand):
+
+    credentials = ()
+
+    def add_arguments(self):
+        self.parser.add_argument('-k', '--keep-months', type=int, default=3)
+        self.parser.add_argument('-c', '--chunk-size', type=int, default=10000)
+        self.parser.add_argument('--no-compact', action='store_true')
+
+    def main(self, args):
+        from .database.partitions import archived_tables
+        for table in archived_tables:
+            self.archive_table(table)
+        if not args.no_compact:
+            self.compact()
+        self.backup()
+
+    def archive_table(self, table):
+
+        from .database.partitions import attach, create_archive_table, detach, month_bounds
+        from .database.schema import snapshot_tables
+
+        key, parent, pointer = snapshot_tables[table]
+
+        con = self.db.connect()
+        cutoff = con.execute("SELECT datetime('now', 'start of month', ?)", ['-%d months' % self.args.keep_months]).fetchone()[0]
+
+        for month, lo, hi in con.execute('''
+            SELECT strftime('%%Y-%%m', created_at), min(id), max(id)
+            FROM %s
+            WHERE created_at < ?
+            GROUP BY 1
+            ORDER BY 1
+        ''' % table, [cutoff]).fetchall():
+
+            start, end = month_bounds(month)
+            name = attach(con, month, create=True)
+
+            with con:
+                create_archive_table(con, name, table)
+                con.execute('INSERT OR IGNORE INTO archives (month) VALUES (?)', [month])
+
+            # Whatever the parent table still points at stays put. Moved rows
+            # replace any left behind in the archive by an interrupted run.
+            where = '''
+                WHERE id >= ? AND id < ? AND created_at >= ? AND created_at < ?
+                AND NOT EXISTS (
+                    SELECT 1 FROM {parent} AS parent
+                    WHERE parent.id = {table}.{key} AND parent.{pointer} = {table}.id
+                )
+            '''.format(table=table, key=key, parent=parent, pointer=pointer)
+            columns = ', '.join(con.columns(table))
+
+            moved = 0
+            for chunk_start in xrange(lo, hi + 1, self.args.chunk_size):
+                params = [chunk_start, min(chunk_start + self.args.chunk_size, hi + 1), start, end]
+                # A transaction over two files isn't atomic in WAL mode, so
+                # the copy is committed before anything is deleted, and only
+                # what made it into the archive is.
+                with con:
+                    con.execute('INSERT OR REPLACE INTO %s.%s (%s) SELECT %s FROM main.%s %s' % (
+                        name, table, columns, columns, table, where,
+                    ), params)
+                with con:
+                    count = con.execute('DELETE FROM main.%s %s AND id IN (SELECT id FROM %s.%s WHERE id >= ? AND id < ?)' % (
+                        table, where, name, table,
+                    ), params + params[:2]).rowcount
+                    if count:
+                        con.bump_generation()
+                moved += count
+
+            # Only months which have fully passed are ever archived, so they
+            # are sealed as soon as they are written. Late rows (e.g. from an
+            # interrupted run) can still land in a sealed month, so it then
+            # needs compacting and backing up again.
+            if moved:
+                with con:
+                    con.execute('''
+                        UPDATE archives
+                        SET sealed_at = coalesce(sealed_at, datetime('now')), compacted_at = NULL, backed_up_at = NULL
+                        WHERE month = ?
+                    ''', [month])
+            detach(con, month)
+            con.execute('PRAGMA incremental_vacuum').fetchall()
+
+            print table, month, 'moved', moved
+
+    def compact(self):
+        import sqlite3
+        from .database.partitions import archive_path
+        con = self.db.connect()
+        for row in con.execute('''
+            SELECT month FROM archives
+            WHERE sealed_at IS NOT NULL AND compacted_at IS NULL
+            ORDER BY month
+        ''').fetchall():
+            path = archive_path(self.db.path, row['month'])
+            archive = sqlite3.connect(path)
+            archive.isolation_level = None
+            archive.execute('VACUUM')
+            archive.close()
+            with con:
+                con.execute("UPDATE archives SET compacted_at = datetime('now'), backed_up_at = NULL WHERE month = ?", [row['month']])
+            print 'compacted', path
+
+    def backup(self):
+        # The rows in an archive are no longer in the main database, so
+        # its routine backups don't have them; each archive is copied once
+        # whenever it has changed instead.
+        from .database.partitions import archive_path
+        con = self.db.connect()
+        for row in con.execute('''
+            SELECT month FROM archives
+            WHERE sealed_at IS NOT NULL AND backed_up_at IS NULL
+            ORDER BY month
+        ''').fetchall():
+            path = self.db.backup_file(archive_path(self.db.path, row['month']))
+            with con:
+                con.execute("UPDATE archives SET backed_up_at = datetime('now') WHERE month = ?", [row['month']])
+            print 'backed up', path
@@ -0,0 +1,222 @@
+import array
+import os
+import re
+import struct
+import sys
+import zlib
+
+from .cli import BaseCommand
+
+
+# Snapshots are stored as the sorted ids, as little-endian 64-bit ints split
+# into byte planes (all the low bytes, then the next, ...) so that the high
+# bytes, which are mostly empty or repeated, compress away, and then zlib'd.
+# The leading byte is a version.
+
+_version = '\x01'
+
+# Where a C long is 64 bits, the ids go in and out of an array of them with
+# a few copies rather than an int at a time.
+_native = array.array('l').itemsize == 8
+
+
+def encode_ids(ids):
+    ids = sorted(set(ids))
+    if _native:
+        raw = array.array('l', ids)
+        if sys.byteorder == 'big':
+            raw.byteswap()
+        raw = raw.tostring()
+    else:
+        raw = struct.pack('<%dq' % len(ids), *ids)
+    return _version + zlib.compress(''.join(raw[i::8] for i in xrange(8)))
+
+
+def decode_ids(blob):
+    blob = str(blob)
+    if blob[0] != _version:
+        raise ValueError('unknown audience encoding %r' % blob[0])
+    planes = zlib.decompress(blob[1:])
+    count = len(planes) // 8
+    raw = bytearray(len(planes))
+    for i in xrange(8):
+        raw[i::8] = planes[i * count:(i + 1) * count]
+    if not _native:
+        return list(struct.unpack('<%dq' % count, str(raw)))
+    ids = array.array('l')
+    ids.fromstring(str(raw))
+    if sys.byteorder == 'big':
+        ids.byteswap()
+    return ids
+
+
+def save_audience(con, kind, ids):
+    # Only stored when it differs from the last one, since "as of" lookups
+    # just take the latest snapshot before the given time anyway.
+    ids = set(ids)
+    blob = encode_ids(ids)
+    row = con.execute('SELECT ids FROM audience_snapshots WHERE kind = ? ORDER BY id DESC LIMIT 1', [kind]).fetchone()
+    if row and str(row['ids']) == blob:
+        return
+    return con.insert('audience_snapshots', {
+        'kind': kind,
+        'count': len(ids),
+        'ids': buffer(blob),
+    })
+
+
+def _snapshot(con, kind, at, column):
+    if at is None:
+        row = con.execute('SELECT %s FROM audience_snapshots WHERE kind = ? ORDER BY id DESC LIMIT 1' % column, [kind]).fetchone()
+    else:
+        row = con.execute('''
+            SELECT %s FROM audience_snapshots
+            WHERE kind = ? AND created_at <= ?
+            ORDER BY id DESC LIMIT 1
+        ''' % column, [kind, at]).fetchone()
+    if row is None:
+        raise ValueError('no %s snapshot%s' % (kind, ' as of %s' % at if at else ''))
+    return row[0]
+
+
+def load_audience(con, kind, at=None):
+    return decode_ids(_snapshot(con, kind, at, 'ids'))
+
+
+def audience_count(con, kind, at=None):
+    return _snapshot(con, kind, at, 'count')
+
+
+_token_re = re.compile(r'''
+    \s*(?:
+        (?P<operand> (?:[\w.]+:)? (?:followers|friends) (?:@[\dT:-]+)? ) |
+        (?P<op> [|&^-] ) |
+        (?P<paren> [()] )
+    )
+''', re.X)
+
+
+# The algebra is done by frozensets, whose operations run in C. Only the
+# smaller side of an intersection needs hashing.
+
+def _intersection(a, b):
+    if len(a) > len(b):
+        a, b = b, a
+    return frozenset(a).intersection(b)
+
+
+_operators = {
+    '|': lambda a, b: frozenset(a).union(b),
+    '&': _intersection,
+    '-': lambda a, b: frozenset(a).difference(b),
+    '^': lambda a, b: frozenset(a).symmetric_difference(b),
+}
+
+
+def tokenize(expr):
+    pos = 0
+    expr = expr.rstrip()
+    while pos < len(expr):
+        m = _token_re.match(expr, pos)
+        if not m:
+            raise ValueError('could not parse audience expression at %r' % expr[pos:])
+        pos = m.end()
+        for type_ in 'operand', 'op', 'paren':
+            if m.group(type_):
+                yield type_, m.group(type_)
+
+
+def parse_operand(token):
+    head, _, at = token.partition('@')
+    account, _, kind = head.rpartition(':')
+    if at:
+        at = at.replace('T', ' ')
+        if len(at) == 10:
+            at += ' 23:59:59'
+    return account or None, kind, at or None
+
+
+class Evaluator(object):
+
+    # Operands look like "[account:](followers|friends)[@date]", and are
+    # combined left to right by | & - ^, with parentheses for grouping.
+
+    def __init__(self, resolve):
+        self.resolve = resolve
+
+    def evaluate(self, expr):
+        self.tokens = list(tokenize(expr))
+        value = self.expr()
+        if self.tokens:
+            raise ValueError('unexpected %r in audience expression' % self.tokens[0][1])
+        return value
+
+    def expr(self):
+        value = self.term()
+        while self.tokens and self.tokens[0][0] == 'op':
+            _, op = self.tokens.pop(0)
+            value = _operators[op](value, self.term())
+        return value
+
+    def term(self):
+        if not self.tokens:
+            raise ValueError('unexpected end of audience expression')
+        type_, token = self.tokens.pop(0)
+        if type_ == 'operand':
+            return self.operand(token)
+        if token == '(':
+            value = self.expr()
+            if not self.tokens or self.tokens.pop(0)[1] != ')':
+                raise ValueError('unbalanced parentheses in audience expression')
+            return value
+        raise ValueError('unexpected %r in audience expression' % token)
+
+    def operand(self, token):
+        return self.resolve(*parse_operand(token))
+
+
+class AudienceCommand(BaseCommand):
+
+    credentials = ()
+
+    def add_arguments(self):
+        self.parser.add_argument('--ids', action='store_true', help='print the ids instead of the count')
+        self.parser.add_argument('expression', nargs='+', help='e.g. "followers - followers@2016-01-01" or "friends - followers"')
+
+    def main(self, args):
+        self._audiences = {}
+        expr = ' '.join(args.expression)
+        try:
+            # A lone operand's size is stored alongside it.
+            tokens = list(tokenize(expr))
+            if not args.ids and len(tokens) == 1 and tokens[0][0] == 'operand':
+                print self.load(audience_count, *parse_operand(tokens[0][1]))
+                return
+            result = Evaluator(self.resolve).evaluate(expr)
+        except ValueError as e:
+            self.parser.error(e.args[0])
+        if args.ids:
+            for id_ in (sorted(result) if isinstance(result, frozenset) else result):
+                sys.stdout.write('%d\n' % id_)
+        else:
+            print len(result)
+
+    def resolve(self, account, kind, at):
+        key = (account, kind, at)
+        if key not in self._audiences:
+            self._audiences[key] = self.load(load_audience, account, kind, at)
+        return self._audiences[key]
+
+    def load(self, func, account, kind, at):
+        if account is None:
+            db = self.db
+        else:
+            from .database import Database
+            db = Database(os.path.join(os.path.dirname(self.db.path), account + '.sqlite'), migrate=False)
+            if not db.exists:
+                raise ValueError('no database for %s at %s' % (account, db.path))
+        con = db.connect(readonly=True)
+        try:
+            return func(con, kind, at)
+        finally:
+            con.close()
@@ -1,18 +1,20 @@
 import argparse
 import os
 
-from .database import Database
-
 
 class BaseCommand(object):
 
+    # Which of the credentials below a command needs; purely local commands
+    # can clear this so that only --username is required.
+    credentials = ('password', 'client-key', 'client-secret', 'owner-key', 'owner-secret')
+
     @classmethod
-    def make_and_run(cls, argv=None):
-        self = cls()
+    def make_and_run(cls, argv=None, prog=None):
+        self = cls(prog=prog)
         return self.run(argv)
 
-    def __init__(self):
-        self.parser = argparse.ArgumentParser()
+    def __init__(self, prog=None):
+        self.parser = argparse.ArgumentParser(prog=prog)
         self.add_base_arguments()
         self.add_arguments()
 
@@ -21,7 +23,7 @@ class BaseCommand(object):
             default = os.environ.get('TWITLOG_' + name.replace('-', '_').upper())
             self.parser.add_argument('--' + name,
                 default=default,
-                required=not default,
+                required=not default and (name == 'username' or name in self.credentials),
             )
 
     def add_arguments(self):
@@ -37,15 +39,29 @@ class BaseCommand(object):
             resource_owner_secret=args.owner_secret,
         )
 
-    def run(self, argv=None):
+    # The database and OAuth session are only set up once a command actually
+    # touches them, so that quick invocations stay quick.
+
+    @property
+    def db(self):
+        try:
+            return self._db
+        except AttributeError:
+            from .database import Database
+            self._db = Database(self.args.username + '.sqlite')
+            self._db.create(if_not_exists=True)
+            return self._db
+
+    @property
+    def oath(self):
+        try:
+            return self._oath
+        except AttributeError:
+            self._oath = self.make_oath_session(self.args)
+            return self._oath
 
+    def run(self, argv=None):
         self.args = self.parser.parse_args(argv)
-
-        self.db = Database(self.args.username + '.sqlite')
-        self.db.create(if_not_exists=True)
-
-        self.oath = self.make_oath_session(self.args)
-
         return self.main(self.args)
 
     def main(self, args):
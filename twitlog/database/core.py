@@ -1,9 +1,11 @@
+import Queue
 import datetime
+import json
 import os
 import sqlite3
 import shutil
-import re
 import logging
+import threading
 
 from .schema import _migrations
 from ..utils import makedirs
@@ -86,37 +88,130 @@ class _Connection(sqlite3.Connection):
     def schema(self, table_name):
         return self.execute('SELECT sql FROM sqlite_master WHERE name = ?', [table_name]).fetchone()['sql']
 
-    def columns(self, table_name):
-        return [row['name'] for row in self.execute('PRAGMA table_info(%s)' % table_name)]
+    def table_info(self, table_name):
+        return self.execute('PRAGMA table_info(%s)' % escape_identifier(table_name)).fetchall()
 
-    def drop_column(self, table_name, column_name):
+    def columns(self, table_name):
+        return [row['name'] for row in self.table_info(table_name)]
+
+    def rebuild_table(self, table_name, drop=(), **kwargs):
+        from .rebuild import TableRebuild
+        TableRebuild(self, table_name, drop=drop, **kwargs).run()
+
+    def drop_column(self, table_name, column_name, **kwargs):
+        # This commits as it goes, so it must be called outside of any
+        # transaction; migrations using it must be marked @no_transaction.
+        self.rebuild_table(table_name, drop=[column_name], **kwargs)
+
+    def add_event(self, type_, subject_id, data):
+        # Call within the transaction making the change, so that the feed
+        # never disagrees with the tables.
+        return self.insert('events', {
+            'type': type_,
+            'subject_id': subject_id,
+            'json': json.dumps(data, sort_keys=True),
+        })
+
+    def partitioned(self, table, query, params=(), **kwargs):
+        from .partitions import partitioned
+        return partitioned(self, table, query, params, **kwargs)
+
+    def scan(self, query, params=(), **kwargs):
+        for page in _scan_pages(self, query, params, **kwargs):
+            for row in page:
+                yield row
+
+    def generation(self):
+        row = self.execute("SELECT value FROM config WHERE key = 'generation'").fetchone()
+        return int(row['value']) if row else 0
+
+    def bump_generation(self):
+        # Lets readers (e.g. the query server's cache) know that something
+        # changed; call it within the transaction making the change.
+        self.execute("INSERT OR IGNORE INTO config (key, value) VALUES ('generation', 0)")
+        self.execute("UPDATE config SET value = value + 1 WHERE key = 'generation'")
 
-        old_columns = self.columns(table_name)
-        new_columns = [x for x in old_columns if x != column_name]
-        if new_columns == old_columns:
-            raise ValueError(column_name)
 
-        old_schema = self.schema(table_name)
-        new_schema = re.sub(r'\)\s*$', ',', old_schema)
-        new_schema = re.sub('%s[^,]+,' % column_name, '', new_schema)
-        new_schema = re.sub(r',$', ')', new_schema)
-        if new_schema == old_schema:
-            raise ValueError('no change in schema: %s' % new_schema)
+def escape_identifier(x):
+    return '"%s"' % x.replace('"', '""')
 
-        self.execute('ALTER TABLE %s RENAME TO old_%s' % (table_name, table_name))
-        self.execute(new_schema)
-        self.execute('INSERT INTO %s (%s) SELECT %s FROM old_%s' % (
-            table_name, ','.join(new_columns), ','.join(new_columns), table_name
-        ))
-        self.execute('DROP TABLE old_%s' % table_name)
 
+def _scan_pages(con, query, params=(), key='id', chunk_size=1000, start=None, descending=False):
+
+    # Keyset pagination: each page picks up after the last key of the one
+    # before, in its own short read transaction, so nothing is held open
+    # (or in memory) between pages. The query may be a bare table name, and
+    # must select the key column.
+    if not query.lstrip().upper().startswith('SELECT'):
+        query = 'SELECT * FROM %s' % escape_identifier(query)
+    key_sql = escape_identifier(key)
+    paged = 'SELECT * FROM (%s) WHERE %s %s ? ORDER BY %s %s LIMIT ?' % (
+        query, key_sql, '<' if descending else '>', key_sql, 'DESC' if descending else 'ASC',
+    )
+    first = 'SELECT * FROM (%s) ORDER BY %s %s LIMIT ?' % (
+        query, key_sql, 'DESC' if descending else 'ASC',
+    )
+
+    last = start
+    while True:
+        with con:
+            if last is None:
+                page = con.execute(first, list(params) + [chunk_size]).fetchall()
+            else:
+                page = con.execute(paged, list(params) + [last, chunk_size]).fetchall()
+        if not page:
+            return
+        yield page
+        if len(page) < chunk_size:
+            return
+        last = page[-1][key]
 
 
+def _prefetch_pages(connect, query, params=(), **kwargs):
 
+    # Reads the next page on a thread (with its own connection) while the
+    # caller is busy with the current one.
+    pages = Queue.Queue(maxsize=1)
+    stop = threading.Event()
 
+    def put(item):
+        while not stop.is_set():
+            try:
+                pages.put(item, timeout=0.1)
+                return True
+            except Queue.Full:
+                pass
 
-def escape_identifier(x):
-    return '"%s"' % x.replace('"', '""')
+    def target():
+        con = None
+        try:
+            con = connect()
+            for page in _scan_pages(con, query, params, **kwargs):
+                if not put(('page', page)):
+                    return
+        except Exception as e:
+            put(('error', e))
+        else:
+            put(('done', None))
+        finally:
+            if con is not None:
+                con.close()
+
+    thread = threading.Thread(target=target)
+    thread.daemon = True
+    thread.start()
+
+    try:
+        while True:
+            type_, value = pages.get()
+            if type_ == 'page':
+                yield value
+            elif type_ == 'error':
+                raise value
+            else:
+                return
+    finally:
+        stop.set()
 
 
 class _Cursor(sqlite3.Cursor):
@@ -188,15 +283,33 @@ class Database(object):
                 if not did_backup:
                     self._backup()
                 did_backup = True
-                with con:
+                if getattr(f, 'transactional', True):
+                    with con:
+                        f(con)
+                        con.execute('INSERT INTO migrations (name) VALUES (?)', [name])
+                else:
                     f(con)
-                    con.execute('INSERT INTO migrations (name) VALUES (?)', [name])
+                    with con:
+                        con.execute('INSERT INTO migrations (name) VALUES (?)', [name])
 
     def _backup(self):
+        # Fold the write-ahead log back in, or the copy would be missing
+        # whatever hasn't been checkpointed yet. Archives only change when
+        # twitlog.archive writes or compacts them, so it backs each one up
+        # then (see ArchiveCommand.backup) rather than with every migration.
+        con = self.connect()
+        try:
+            con.execute('PRAGMA wal_checkpoint(TRUNCATE)').fetchall()
+        finally:
+            con.close()
+        self.backup_file(self.path)
+
+    def backup_file(self, path):
         backup_dir = os.path.join(os.path.dirname(self.path), 'backups')
-        backup_path = os.path.join(backup_dir, os.path.basename(self.path) + '.' + datetime.datetime.utcnow().isoformat('T'))
+        backup_path = os.path.join(backup_dir, os.path.basename(path) + '.' + datetime.datetime.utcnow().isoformat('T'))
         makedirs(backup_dir)
-        shutil.copyfile(self.path, backup_path)
+        shutil.copyfile(path, backup_path)
+        return backup_path
 
     @property
     def exists(self):
@@ -210,16 +323,33 @@ class Database(object):
         con = self.connect(create=True)
         self._migrate(con)
 
-    def connect(self, create=False):
+    def connect(self, create=False, readonly=False):
         if not create and not self.exists:
             raise ValueError('database does not exist', self.path)
         con = sqlite3.connect(self.path, factory=_Connection)
         con.execute('PRAGMA foreign_keys = ON')
+        if readonly:
+            con.execute('PRAGMA query_only = ON')
         return con
 
     def cursor(self):
         return self.connect().cursor()
 
+    def scan(self, query, params=(), prefetch=False, **kwargs):
+        connect = lambda: self.connect(readonly=True)
+        if prefetch:
+            for page in _prefetch_pages(connect, query, params, **kwargs):
+                for row in page:
+                    yield row
+            return
+        con = connect()
+        try:
+            for page in _scan_pages(con, query, params, **kwargs):
+                for row in page:
+                    yield row
+        finally:
+            con.close()
+
     def execute(self, *args):
         return self.connect().execute(*args)
 
@@ -0,0 +1,133 @@
+import os
+import sqlite3
+import urllib
+
+from .core import escape_identifier
+from .schema import snapshot_tables
+from ..utils import makedirs
+
+
+# Snapshot rows older than a few months are moved out into one archive
+# database per month (see twitlog.archive), which are only ATTACHed when a
+# query asks for a time range which needs them.
+archived_tables = ['tweet_metrics', 'user_profiles']
+
+
+def month_bounds(month):
+    year, month_ = map(int, month.split('-'))
+    return (
+        '%04d-%02d-01 00:00:00' % (year, month_),
+        '%04d-%02d-01 00:00:00' % (year + month_ // 12, month_ % 12 + 1),
+    )
+
+
+def archive_path(path, month):
+    base, ext = os.path.splitext(os.path.basename(path))
+    return os.path.join(os.path.dirname(path), 'archives', '%s.%s%s' % (base, month, ext or '.sqlite'))
+
+
+def schema_name(month):
+    return 'archive_' + month.replace('-', '_')
+
+
+def main_path(con):
+    for row in con.execute('PRAGMA database_list'):
+        if row['name'] == 'main':
+            return row['file']
+
+
+def months(con, since=None, until=None):
+    out = []
+    for row in con.execute('SELECT month FROM archives ORDER BY month'):
+        start, end = month_bounds(row['month'])
+        if (since is None or end > since) and (until is None or start < until):
+            out.append(row['month'])
+    return out
+
+
+def attach(con, month, create=False):
+
+    # Only the archiver writes to them; everything else attaches read-only.
+    name = schema_name(month)
+    if any(row['name'] == name for row in con.execute('PRAGMA database_list')):
+        return name
+
+    path = archive_path(main_path(con), month)
+    if create:
+        makedirs(os.path.dirname(path))
+    elif not os.path.exists(path):
+        raise ValueError('missing archive', month, path)
+
+    try:
+        if create:
+            con.execute('ATTACH DATABASE ? AS %s' % escape_identifier(name), [path])
+        else:
+            con.execute('ATTACH DATABASE ? AS %s' % escape_identifier(name), ['file:%s?mode=ro' % urllib.quote(os.path.abspath(path))])
+    except sqlite3.OperationalError as e:
+        if 'too many attached databases' in e.args[0]:
+            raise ValueError('too many attached databases', month)
+        raise
+    return name
+
+
+def detach(con, month):
+    con.execute('DETACH DATABASE %s' % escape_identifier(schema_name(month)))
+
+
+def create_archive_table(con, name, table):
+    # Plain copies of the columns; archives stand alone, so there is nothing
+    # for their foreign keys to point at.
+    defs = []
+    for column in con.table_info(table):
+        defs.append('%s %s%s' % (
+            escape_identifier(column['name']),
+            column['type'],
+            ' PRIMARY KEY NOT NULL' if column['pk'] else '',
+        ))
+    key = snapshot_tables[table][0]
+    con.execute('CREATE TABLE IF NOT EXISTS %s.%s (%s)' % (
+        escape_identifier(name), escape_identifier(table), ', '.join(defs),
+    ))
+    con.execute('CREATE INDEX IF NOT EXISTS %s.%s ON %s (%s)' % (
+        escape_identifier(name), escape_identifier('%s_%s' % (table, key)),
+        escape_identifier(table), escape_identifier(key),
+    ))
+
+
+def partitioned(con, table, query, params=(), since=None, until=None, batch_size=8):
+
+    # Yields the rows of query (with "%s" standing in for the table) run
+    # over the table and every archive overlapping [since, until). SQLite
+    # only allows a handful of attached databases at once, so archives are
+    # attached, read and detached a batch at a time; rows come back grouped
+    # by batch, so callers wanting an order must sort them. Attaching can't
+    # be done inside a transaction.
+
+    columns = ', '.join(escape_identifier(c) for c in con.columns(table))
+
+    conditions = []
+    where_params = []
+    if since is not None:
+        conditions.append('created_at >= ?')
+        where_params.append(since)
+    if until is not None:
+        conditions.append('created_at < ?')
+        where_params.append(until)
+    where = ' WHERE ' + ' AND '.join(conditions) if conditions else ''
+
+    archived = months(con, since, until) if table in archived_tables else []
+    batches = [archived[i:i + batch_size] for i in xrange(0, len(archived), batch_size)]
+
+    for i, batch in enumerate(batches or [[]]):
+        schemas = ['main'] if i == 0 else []
+        try:
+            for month in batch:
+                schemas.append(attach(con, month))
+            parts = ['SELECT %s FROM %s.%s%s' % (columns, escape_identifier(name), escape_identifier(table), where) for name in schemas]
+            rows = con.execute(query % ' UNION ALL '.join(parts), where_params * len(parts) + list(params)).fetchall()
+        finally:
+            for month in batch:
+                if any(row['name'] == schema_name(month) for row in con.execute('PRAGMA database_list')):
+                    detach(con, month)
+        for row in rows:
+            yield row
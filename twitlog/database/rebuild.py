@@ -0,0 +1,286 @@
+import logging
+import re
+
+from .core import escape_identifier
+
+log = logging.getLogger(__name__)
+
+
+# PRAGMA table_info has no way to tell us about these, so rather than
+# silently losing them we refuse to rebuild tables which use them.
+_unsupported_re = re.compile(r'\b(CHECK\s*\(|COLLATE\b)', re.I)
+
+
+def _mentions(sql, name):
+    pattern = r'(?<![\w$])(?:%s|"%s"|`%s`|\[%s\])(?![\w$])' % (
+        re.escape(name), re.escape(name.replace('"', '""')), re.escape(name), re.escape(name),
+    )
+    return re.search(pattern, sql, re.I) is not None
+
+
+class TableRebuild(object):
+
+    # Rebuilds a table into a new schema without holding a write lock for
+    # the duration. The new table is populated in short rowid-ranged
+    # transactions while triggers on the old table mirror any concurrent
+    # writes (from any process) into it, and then the two are swapped in one
+    # final transaction.
+
+    def __init__(self, con, table_name, drop=(), chunk_size=10000, progress=None):
+
+        self.con = con
+        self.table_name = table_name
+        self.drop = set(drop)
+        self.chunk_size = chunk_size
+        self.progress = progress
+
+        self.new_name = '_rebuild_' + table_name
+
+        self.old_columns = self.con.table_info(table_name)
+        if not self.old_columns:
+            raise ValueError('no such table', table_name)
+        missing = self.drop.difference(c['name'] for c in self.old_columns)
+        if missing:
+            raise ValueError(sorted(missing)[0])
+
+        self.columns = [c for c in self.old_columns if c['name'] not in self.drop]
+        if not self.columns:
+            raise ValueError('cannot drop all columns', table_name)
+
+        m = _unsupported_re.search(self.con.schema(table_name))
+        if m:
+            raise ValueError('cannot rebuild a table with a %s clause' % m.group(1).rstrip('( ').upper(), table_name)
+
+        # There is no telling what a trigger which mentions a dropped column
+        # was meant to do without it, so we leave that to whoever wrote it.
+        for row in self.con.execute('''
+            SELECT name, sql FROM sqlite_master
+            WHERE tbl_name = ? AND type = 'trigger' AND sql IS NOT NULL
+        ''', [table_name]):
+            if self.is_own_trigger(row['name']):
+                continue
+            for name in self.drop:
+                if _mentions(row['sql'], name):
+                    raise ValueError('cannot drop %s while trigger %s uses it' % (name, row['name']), table_name)
+
+    def pk_columns(self):
+        return [c['name'] for c in sorted(self.columns, key=lambda c: c['pk']) if c['pk']]
+
+    def has_rowid_alias(self):
+        # An INTEGER PRIMARY KEY is the rowid, so copying it preserves rowids.
+        pk = [c for c in self.columns if c['pk']]
+        return len(pk) == 1 and (pk[0]['type'] or '').upper() == 'INTEGER'
+
+    def is_autoincrement(self):
+        sql = self.con.schema(self.table_name)
+        return self.has_rowid_alias() and 'AUTOINCREMENT' in sql.upper()
+
+    def column_sql(self, column, single_pk):
+        parts = [escape_identifier(column['name'])]
+        if column['type']:
+            parts.append(column['type'])
+        if single_pk and column['pk']:
+            parts.append('PRIMARY KEY')
+            if self.is_autoincrement():
+                parts.append('AUTOINCREMENT')
+        if column['notnull']:
+            parts.append('NOT NULL')
+        if column['dflt_value'] is not None:
+            parts.append('DEFAULT (%s)' % column['dflt_value'])
+        return ' '.join(parts)
+
+    def constraint_sql(self):
+
+        names = set(c['name'] for c in self.columns)
+        constraints = []
+
+        pk = self.pk_columns()
+        if len(pk) > 1:
+            constraints.append('PRIMARY KEY (%s)' % ', '.join(escape_identifier(x) for x in pk))
+
+        for index in self.con.execute('PRAGMA index_list(%s)' % escape_identifier(self.table_name)):
+            if index['origin'] != 'u':
+                continue
+            cols = [row['name'] for row in self.con.execute('PRAGMA index_info(%s)' % escape_identifier(index['name']))]
+            if names.issuperset(cols):
+                constraints.append('UNIQUE (%s)' % ', '.join(escape_identifier(x) for x in cols))
+
+        foreign_keys = {}
+        for row in self.con.execute('PRAGMA foreign_key_list(%s)' % escape_identifier(self.table_name)):
+            foreign_keys.setdefault(row['id'], []).append(row)
+        for _, rows in sorted(foreign_keys.iteritems()):
+            rows.sort(key=lambda r: r['seq'])
+            from_ = [r['from'] for r in rows]
+            if not names.issuperset(from_):
+                continue
+            sql = 'FOREIGN KEY (%s) REFERENCES %s' % (
+                ', '.join(escape_identifier(x) for x in from_),
+                escape_identifier(rows[0]['table']),
+            )
+            to = [r['to'] for r in rows]
+            if all(to):
+                sql += ' (%s)' % ', '.join(escape_identifier(x) for x in to)
+            if rows[0]['on_update'] != 'NO ACTION':
+                sql += ' ON UPDATE ' + rows[0]['on_update']
+            if rows[0]['on_delete'] != 'NO ACTION':
+                sql += ' ON DELETE ' + rows[0]['on_delete']
+            constraints.append(sql)
+
+        return constraints
+
+    def create_sql(self, name):
+        single_pk = len(self.pk_columns()) == 1
+        defs = [self.column_sql(c, single_pk) for c in self.columns]
+        defs.extend(self.constraint_sql())
+        return 'CREATE TABLE %s (\n    %s\n)' % (escape_identifier(name), ',\n    '.join(defs))
+
+    def copy_columns(self):
+        names = [escape_identifier(c['name']) for c in self.columns]
+        if not self.has_rowid_alias():
+            names.insert(0, '_rowid_')
+        return names
+
+    def trigger_sql(self):
+
+        columns = self.copy_columns()
+        table = escape_identifier(self.table_name)
+        new = escape_identifier(self.new_name)
+
+        def values(prefix):
+            return ', '.join('%s.%s' % (prefix, x) for x in columns)
+
+        yield '''CREATE TRIGGER %s AFTER INSERT ON %s BEGIN
+            INSERT OR REPLACE INTO %s (%s) VALUES (%s);
+        END''' % (escape_identifier(self.new_name + '_insert'), table, new, ', '.join(columns), values('NEW'))
+
+        yield '''CREATE TRIGGER %s AFTER UPDATE ON %s BEGIN
+            DELETE FROM %s WHERE _rowid_ = OLD._rowid_;
+            INSERT OR REPLACE INTO %s (%s) VALUES (%s);
+        END''' % (escape_identifier(self.new_name + '_update'), table, new, new, ', '.join(columns), values('NEW'))
+
+        yield '''CREATE TRIGGER %s AFTER DELETE ON %s BEGIN
+            DELETE FROM %s WHERE _rowid_ = OLD._rowid_;
+        END''' % (escape_identifier(self.new_name + '_delete'), table, new)
+
+    def is_own_trigger(self, name):
+        return name in set(self.new_name + '_' + suffix for suffix in ('insert', 'update', 'delete'))
+
+    def drop_triggers(self):
+        for suffix in 'insert', 'update', 'delete':
+            self.con.execute('DROP TRIGGER IF EXISTS %s' % escape_identifier(self.new_name + '_' + suffix))
+
+    def run(self):
+
+        # Migrations which rebuild tables need to be @no_transaction.
+        if self.con._context_depth:
+            raise RuntimeError('cannot rebuild a table inside a transaction; use a @no_transaction migration')
+
+        # Indexes and triggers are recreated verbatim after the swap, minus
+        # indexes on a dropped column, and any of our own triggers left
+        # behind by a rebuild which was killed part-way.
+        extras = []
+        for row in self.con.execute('''
+            SELECT type, name, sql FROM sqlite_master
+            WHERE tbl_name = ? AND type IN ('index', 'trigger') AND sql IS NOT NULL
+        ''', [self.table_name]):
+            if row['type'] == 'trigger' and self.is_own_trigger(row['name']):
+                continue
+            if row['type'] == 'index':
+                cols = [r['name'] for r in self.con.execute('PRAGMA index_info(%s)' % escape_identifier(row['name']))]
+                if self.drop.intersection(cols):
+                    log.warning('dropping index %s on %s' % (row['name'], self.table_name))
+                    continue
+            extras.append(row['sql'])
+
+        create_sql = self.create_sql(self.new_name)
+        log.debug(create_sql)
+
+        with self.con:
+            self.con.execute('DROP TABLE IF EXISTS %s' % escape_identifier(self.new_name))
+            self.con.execute(create_sql)
+            self.drop_triggers()
+            for sql in self.trigger_sql():
+                self.con.execute(sql)
+            hi, total = self.con.execute('SELECT max(_rowid_), count(*) FROM %s' % escape_identifier(self.table_name)).fetchone()
+
+        try:
+            self.copy(hi, total)
+            self.swap(extras)
+        except:
+            self.drop_triggers()
+            self.con.execute('DROP TABLE IF EXISTS %s' % escape_identifier(self.new_name))
+            raise
+
+    def copy(self, hi, total):
+
+        if hi is None:
+            return
+
+        table = escape_identifier(self.table_name)
+
+        # Rows which were already mirrored by the triggers are newer than
+        # anything we could copy here, so they win.
+        columns = ', '.join(self.copy_columns())
+        query = 'INSERT OR IGNORE INTO %s (%s) SELECT %s FROM %s WHERE _rowid_ > ? AND _rowid_ <= ?' % (
+            escape_identifier(self.new_name), columns, columns, table,
+        )
+
+        # Chunks are picked by keyset rather than by rowid span, since ids
+        # (e.g. Twitter's) can be spread very thinly. Anything past hi was
+        # written after we started, and so came over via the triggers.
+        boundary = 'SELECT _rowid_ FROM %s WHERE _rowid_ > ? AND _rowid_ <= ? ORDER BY _rowid_ LIMIT 1 OFFSET ?' % table
+        remainder = 'SELECT count(*) FROM %s WHERE _rowid_ > ? AND _rowid_ <= ?' % table
+
+        last = None
+        done = 0
+        while last is None or last < hi:
+            start = last if last is not None else self.con.execute('SELECT min(_rowid_) - 1 FROM %s' % table).fetchone()[0]
+            with self.con:
+                row = self.con.execute(boundary, [start, hi, self.chunk_size - 1]).fetchone()
+                if row:
+                    end, count = row[0], self.chunk_size
+                else:
+                    end, count = hi, self.con.execute(remainder, [start, hi]).fetchone()[0]
+                self.con.execute(query, [start, end])
+            last = end
+            done = min(done + count, total)
+            log.info('rebuilding %s: %d/%d rows (%.1f%%)' % (self.table_name, done, total, 100.0 * done / max(total, 1)))
+            if self.progress:
+                self.progress(done, total)
+
+    def swap(self, extras):
+
+        table = escape_identifier(self.table_name)
+
+        # Foreign keys can only be toggled outside of a transaction; without
+        # this, dropping a referenced table would cascade into its children.
+        fk_enabled = self.con.execute('PRAGMA foreign_keys').fetchone()[0]
+        self.con.execute('PRAGMA foreign_keys = OFF')
+        try:
+            with self.con:
+
+                # Nothing else can write once we hold the lock, so the
+                # triggers have caught up with everything by now.
+                self.drop_triggers()
+
+                seq = None
+                if self.is_autoincrement():
+                    row = self.con.execute('SELECT seq FROM sqlite_sequence WHERE name = ?', [self.table_name]).fetchone()
+                    seq = row and row[0]
+
+                self.con.execute('DROP TABLE %s' % table)
+                self.con.execute('ALTER TABLE %s RENAME TO %s' % (escape_identifier(self.new_name), table))
+                for sql in extras:
+                    self.con.execute(sql)
+
+                # Don't let AUTOINCREMENT reuse the IDs of deleted rows.
+                if seq is not None:
+                    self.con.execute('UPDATE sqlite_sequence SET seq = ? WHERE name = ? AND seq < ?', [seq, self.table_name, seq])
+
+                if fk_enabled:
+                    bad = self.con.execute('PRAGMA foreign_key_check(%s)' % table).fetchone()
+                    if bad:
+                        raise ValueError('foreign key violation after rebuild', self.table_name, tuple(bad))
+        finally:
+            if fk_enabled:
+                self.con.execute('PRAGMA foreign_keys = ON')
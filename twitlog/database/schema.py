@@ -3,6 +3,21 @@ _migrations = []
 patch = _migrations.append
 
 
+# The snapshot tables, with the column naming what they are a snapshot of,
+# and the pointer on that parent to the latest snapshot.
+snapshot_tables = {
+    'tweet_metrics': ('tweet_id', 'tweets', 'last_metrics_id'),
+    'user_profiles': ('user_id', 'users', 'last_profile_id'),
+    'user_relationships': ('user_id', 'users', 'last_relationship_id'),
+}
+
+
+def no_transaction(f):
+    # For migrations (e.g. VACUUM) which cannot run inside a transaction.
+    f.transactional = False
+    return f
+
+
 @patch
 def create_config_table(con):
     con.execute('''CREATE TABLE config (
@@ -47,3 +62,71 @@ def create_tweet_tables2(con):
         tweet_id INTEGER NOT NULL REFERENCES tweets (id),
         json TEXT NOT NULL
     )''')
+
+
+@patch
+def create_snapshot_indexes(con):
+    con.execute('CREATE INDEX user_profiles_user_id ON user_profiles (user_id)')
+    con.execute('CREATE INDEX user_relationships_user_id ON user_relationships (user_id)')
+    con.execute('CREATE INDEX tweet_metrics_tweet_id ON tweet_metrics (tweet_id)')
+
+
+@patch
+@no_transaction
+def enable_incremental_vacuum(con):
+    # Switching an existing database over requires one full VACUUM, but
+    # from then on retention can give space back a little at a time.
+    con.execute('PRAGMA auto_vacuum = INCREMENTAL')
+    con.execute('VACUUM')
+
+
+@patch
+def create_web_sessions_table(con):
+    con.execute('''CREATE TABLE web_sessions (
+        id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
+        created_at TIMESTAMP NOT NULL DEFAULT (datetime('now')),
+        validated_at TIMESTAMP,
+        expires_at TIMESTAMP,
+        cookies TEXT NOT NULL
+    )''')
+
+
+@patch
+@no_transaction
+def enable_wal(con):
+    # Readers (like the query server) no longer block the sync commands.
+    con.execute('PRAGMA journal_mode = WAL').fetchall()
+
+
+@patch
+def create_events_table(con):
+    con.execute('''CREATE TABLE events (
+        seq INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
+        created_at TIMESTAMP NOT NULL DEFAULT (datetime('now')),
+        type TEXT NOT NULL,
+        subject_id INTEGER NOT NULL,
+        json TEXT NOT NULL
+    )''')
+
+
+@patch
+def create_archives_table(con):
+    con.execute('''CREATE TABLE archives (
+        month TEXT PRIMARY KEY NOT NULL,
+        created_at TIMESTAMP NOT NULL DEFAULT (datetime('now')),
+        sealed_at TIMESTAMP,
+        compacted_at TIMESTAMP,
+        backed_up_at TIMESTAMP
+    )''')
+
+
+@patch
+def create_audience_snapshots_table(con):
+    con.execute('''CREATE TABLE audience_snapshots (
+        id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
+        created_at TIMESTAMP NOT NULL DEFAULT (datetime('now')),
+        kind TEXT NOT NULL,
+        count INTEGER NOT NULL,
+        ids BLOB NOT NULL
+    )''')
+    con.execute('CREATE INDEX audience_snapshots_kind ON audience_snapshots (kind, created_at)')
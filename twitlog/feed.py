@@ -0,0 +1,86 @@
+import json
+import sys
+
+from .cli import BaseCommand
+
+
+class Feed(object):
+
+    # Reads the events table from where the named consumer last left off.
+    # Offsets live in the config table as "feed.<consumer>", and only move
+    # forward once a batch is acknowledged, so delivery is at-least-once.
+
+    def __init__(self, db, consumer):
+        self.db = db
+        self.consumer = consumer
+        self.key = 'feed.' + consumer
+
+    @property
+    def offset(self):
+        con = self.db.connect(readonly=True)
+        try:
+            row = con.execute('SELECT value FROM config WHERE key = ?', [self.key]).fetchone()
+        finally:
+            con.close()
+        return int(row['value']) if row else 0
+
+    def read(self, limit=1000, offset=None):
+        offset = self.offset if offset is None else offset
+        con = self.db.connect(readonly=True)
+        try:
+            with con:
+                return [{
+                    'seq': row['seq'],
+                    'created_at': row['created_at'],
+                    'type': row['type'],
+                    'subject_id': row['subject_id'],
+                    'data': json.loads(row['json']),
+                } for row in con.execute('''
+                    SELECT seq, created_at, type, subject_id, json
+                    FROM events
+                    WHERE seq > ?
+                    ORDER BY seq
+                    LIMIT ?
+                ''', [offset, limit])]
+        finally:
+            con.close()
+
+    def ack(self, seq):
+        con = self.db.connect()
+        try:
+            with con:
+                con.insert('config', {'key': self.key, 'value': seq}, on_conflict='REPLACE')
+        finally:
+            con.close()
+
+    def batches(self, limit=1000):
+        # Each batch is acknowledged when the next one is asked for.
+        offset = self.offset
+        while True:
+            batch = self.read(limit, offset)
+            if not batch:
+                return
+            yield batch
+            offset = batch[-1]['seq']
+            self.ack(offset)
+
+
+class FeedCommand(BaseCommand):
+
+    credentials = ()
+
+    def add_arguments(self):
+        self.parser.add_argument('-c', '--consumer', default='default')
+        self.parser.add_argument('-n', '--batch-size', type=int, default=1000)
+        self.parser.add_argument('--peek', action='store_true', help="don't advance the consumer's offset")
+
+    def main(self, args):
+        feed = Feed(self.db, args.consumer)
+        if args.peek:
+            batches = [feed.read(args.batch_size)]
+        else:
+            batches = feed.batches(args.batch_size)
+        for batch in batches:
+            for event in batch:
+                sys.stdout.write(json.dumps(event, sort_keys=True) + '\n')
+            sys.stdout.flush()
@@ -1,10 +1,13 @@
 import json
 
+from .audience import save_audience
 from .cli import BaseCommand
 
 
 class FollowersCommand(BaseCommand):
 
+    credentials = ('client-key', 'client-secret', 'owner-key', 'owner-secret')
+
     def add_arguments(self):
         self.parser.add_argument('-x', '--no-relationships', action='store_true')
         self.parser.add_argument('-X', '--no-profiles', action='store_true')
@@ -17,22 +20,29 @@ class FollowersCommand(BaseCommand):
 
     def update_relationships(self):
 
+        # Merge the data from the two API sources, and the database. All of
+        # the network calls are done before we lock anything.
+        users = {}
+        follower_ids = self.get_follower_ids()
+        friend_ids = self.get_friend_ids()
+        for id_ in follower_ids:
+            users.setdefault(id_, {})['is_follower'] = True
+        for id_ in friend_ids:
+            users.setdefault(id_, {})['is_friend'] = True
+        for row in self.db.scan('''
+            SELECT user.id, rel.is_friend, rel.is_follower
+            FROM users as user
+            JOIN user_relationships as rel
+            ON user.last_relationship_id = rel.id
+        '''):
+            users.setdefault(row['id'], {})['user'] = row
+
         with self.db.connect() as con:
 
-            # Merge the data from the two API sources, and the database.
-            users = {}
-            for id_ in self.get_follower_ids():
-                users.setdefault(id_, {})['is_follower'] = True
-            for id_ in self.get_friend_ids():
-                users.setdefault(id_, {})['is_friend'] = True
-            for row in con.execute('''
-                SELECT user.id, rel.is_friend, rel.is_follower
-                FROM users as user
-                JOIN user_relationships as rel
-                ON user.last_relationship_id = rel.id
-            '''):
-                users.setdefault(row['id'], {})['user'] = row
+            save_audience(con, 'followers', follower_ids)
+            save_audience(con, 'friends', friend_ids)
 
+            changed = False
             for uid, meta in users.iteritems():
 
                 user = meta.get('user')
@@ -55,6 +65,17 @@ class FollowersCommand(BaseCommand):
                     con.update('users', {
                         'last_relationship_id': new_rel_id
                     }, where={'id': uid})
+                    con.add_event('relationship', uid, {
+                        'relationship_id': new_rel_id,
+                        'is_follower': is_follower,
+                        'is_friend': is_friend,
+                        'was_follower': bool(user['is_follower']) if user else None,
+                        'was_friend': bool(user['is_friend']) if user else None,
+                    })
+                    changed = True
+
+            if changed:
+                con.bump_generation()
 
     def get_follower_ids(self):
         ids = []
@@ -69,19 +90,26 @@ class FollowersCommand(BaseCommand):
         return ids
 
     def update_profiles(self):
-        all_ids = []
-        with self.db.connect() as con:
-            for row in con.execute('''
-                SELECT user.id
-                FROM users as user
-                WHERE user.last_profile_id IS NULL
-            '''):
-                all_ids.append(row['id'])
-        for i in xrange(0, len(all_ids), 100):
-            ids_str = ','.join(map(str, all_ids[i:i + 100]))
-            profiles = self.oath.get_json('users/lookup', params={
-                'user_id': ids_str,
-            })
+        # Pages line up with what users/lookup takes in one request.
+        con = self.db.connect()
+        ids = []
+        for row in self.db.scan('''
+            SELECT user.id
+            FROM users as user
+            WHERE user.last_profile_id IS NULL
+        ''', chunk_size=100, prefetch=True):
+            ids.append(row['id'])
+            if len(ids) == 100:
+                self.lookup_profiles(con, ids)
+                ids = []
+        if ids:
+            self.lookup_profiles(con, ids)
+
+    def lookup_profiles(self, con, ids):
+        profiles = self.oath.get_json('users/lookup', params={
+            'user_id': ','.join(map(str, ids)),
+        })
+        with con:
             for profile in profiles:
                 profile.pop('status', None) # We don't care about it.
                 pid = con.insert('user_profiles', {
@@ -89,4 +117,5 @@ class FollowersCommand(BaseCommand):
                     'json': json.dumps(profile, sort_keys=True),
                 })
                 con.update('users', {'last_profile_id': pid}, {'id': profile['id']})
-
+                con.add_event('profile', profile['id'], {'profile_id': pid})
+            con.bump_generation()
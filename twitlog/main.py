@@ -0,0 +1,53 @@
+import sys
+
+
+# Subcommands are named by import path, so that nothing but the one being
+# run is ever imported.
+commands = {
+    'analytics': ('twitlog.analytics:AnalyticsCommand', 'fetch tweets and their analytics'),
+    'archive': ('twitlog.archive:ArchiveCommand', 'move old snapshots into monthly archives'),
+    'audience': ('twitlog.audience:AudienceCommand', 'set algebra over follower and friend snapshots'),
+    'feed': ('twitlog.feed:FeedCommand', 'print new change events as JSON lines'),
+    'followers': ('twitlog.followers:FollowersCommand', 'track followers, friends and their profiles'),
+    'reprocess': ('twitlog.reprocess:ReprocessCommand', 'rebuild derived data from stored JSON in parallel'),
+    'retention': ('twitlog.retention:RetentionCommand', 'downsample old snapshot history'),
+    'serve': ('twitlog.server:ServeCommand', 'serve read-only JSON queries over HTTP'),
+}
+
+
+def register(name, path, help=''):
+    commands[name] = (path, help)
+
+
+def load(name):
+    path, _ = commands[name]
+    mod_name, cls_name = path.split(':')
+    __import__(mod_name)
+    return getattr(sys.modules[mod_name], cls_name)
+
+
+def usage(out):
+    out.write('usage: twitlog <command> [args...]\n\ncommands:\n')
+    for name, (_, help) in sorted(commands.iteritems()):
+        out.write('  %-12s%s\n' % (name, help))
+
+
+def main(argv=None):
+
+    argv = sys.argv[1:] if argv is None else list(argv)
+
+    if not argv or argv[0] in ('-h', '--help', 'help'):
+        usage(sys.stdout)
+        return 0
+
+    name = argv.pop(0)
+    if name not in commands:
+        sys.stderr.write('twitlog: unknown command %r\n\n' % name)
+        usage(sys.stderr)
+        return 2
+
+    return load(name).make_and_run(argv, prog='twitlog ' + name)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,181 @@
+import collections
+import itertools
+import json
+import time
+
+from .cli import BaseCommand
+
+
+# Transforms re-derive data from the stored JSON of a table's rows. Each is
+# given the decoded JSON and the row, and returns a dict of columns to
+# update (JSON-able values are serialized), or None to leave the row alone.
+# Register your own with @transform from a module passed via --module.
+transforms = {}
+
+
+def transform(table, name=None):
+    def _decorator(func):
+        transforms[name or func.__name__.replace('_', '-')] = (table, func)
+        return func
+    return _decorator
+
+
+@transform('user_profiles')
+def profile_strip_status(data, row):
+    # update_profiles hasn't always dropped these.
+    if data.pop('status', None) is not None:
+        return {'json': data}
+
+
+@transform('tweet_metrics')
+def metrics_drop_engagements(data, row):
+    # Just a total of the others; see update_analytics.
+    if data.pop('Engagements', None) is not None:
+        return {'json': data}
+
+
+def _init_worker(modules):
+    for name in modules:
+        __import__(name)
+
+
+def _iter_ranges(name, path, start, hi, chunk_size):
+
+    # Chunk boundaries are found by keyset, since ids (e.g. Twitter's) can be
+    # spread far too thinly to step through. This is read from lazily while
+    # the caller is writing, so it has its own connection.
+    from .database import Database
+    table, _ = transforms[name]
+    con = Database(path, migrate=False).connect(readonly=True)
+    try:
+        while start < hi:
+            row = con.execute('SELECT id FROM %s WHERE id > ? AND id <= ? ORDER BY id LIMIT 1 OFFSET ?' % table, [start, hi, chunk_size - 1]).fetchone()
+            end = row[0] if row else hi
+            yield name, path, start, end
+            start = end
+    finally:
+        con.close()
+
+
+def _process_range(task):
+
+    # Runs in the pool; reads the ids in (lo, hi] and hands back the changes
+    # for the one writer in the parent to apply.
+    name, path, lo, hi = task
+    table, func = transforms[name]
+
+    from .database import Database
+    con = Database(path, migrate=False).connect(readonly=True)
+
+    count = 0
+    changes = []
+    try:
+        with con:
+            for row in con.execute('SELECT * FROM %s WHERE id > ? AND id <= ? ORDER BY id' % table, [lo, hi]):
+                count += 1
+                if row['json'] is None:
+                    continue
+                updates = func(json.loads(row['json']), row)
+                if not updates:
+                    continue
+                for key, value in updates.items():
+                    if isinstance(value, (dict, list)):
+                        value = json.dumps(value, sort_keys=True)
+                    if value == row[key]:
+                        del updates[key]
+                    else:
+                        updates[key] = value
+                if updates:
+                    changes.append((row['id'], updates))
+    finally:
+        con.close()
+
+    return hi, count, changes
+
+
+class ReprocessCommand(BaseCommand):
+
+    credentials = ()
+
+    def add_arguments(self):
+        self.parser.add_argument('-m', '--module', action='append', default=[], help='import to register more transforms')
+        self.parser.add_argument('-j', '--jobs', type=int, help='worker processes (default: one per CPU)')
+        self.parser.add_argument('-c', '--chunk-size', type=int, default=5000)
+        self.parser.add_argument('--restart', action='store_true', help='ignore where a previous run left off')
+        self.parser.add_argument('-n', '--dry-run', action='store_true')
+        self.parser.add_argument('transform', nargs='*')
+
+    def main(self, args):
+
+        _init_worker(args.module)
+
+        if not args.transform:
+            for name, (table, _) in sorted(transforms.iteritems()):
+                print '%-30s %s' % (name, table)
+            return
+
+        for name in args.transform:
+            if name not in transforms:
+                raise ValueError('unknown transform', name)
+
+        import multiprocessing
+        jobs = args.jobs or multiprocessing.cpu_count()
+        pool = multiprocessing.Pool(jobs, _init_worker, (args.module, ))
+        try:
+            for name in args.transform:
+                self.reprocess(pool, name, window=2 * jobs)
+        finally:
+            pool.terminate()
+
+    def reprocess(self, pool, name, window):
+
+        table, _ = transforms[name]
+        key = 'reprocess.' + name
+
+        con = self.db.connect()
+        lo, hi = con.execute('SELECT min(id), max(id) FROM %s' % table).fetchone()
+        if lo is None:
+            print name, 'nothing to do'
+            return
+
+        # Progress (the last id done) is saved with each chunk's writes, so an
+        # interrupted run carries on from the last one to land.
+        if self.args.restart:
+            with con:
+                con.execute('DELETE FROM config WHERE key = ?', [key])
+        row = con.execute('SELECT value FROM config WHERE key = ?', [key]).fetchone()
+        start = max(lo - 1, int(row['value'])) if row else lo - 1
+        if start >= hi:
+            print name, 'already done; use --restart to run it again'
+            return
+        total = con.execute('SELECT count(*) FROM %s WHERE id > ? AND id <= ?' % table, [start, hi]).fetchone()[0]
+
+        tasks = _iter_ranges(name, self.db.path, start, hi, self.args.chunk_size)
+
+        rows = updated = 0
+        started_at = time.time()
+
+        # Only a window of chunks is in flight at once, so that the workers
+        # can't get ahead of the one writer and pile up results in memory.
+        # They are written in order, so that the saved offset never skips
+        # past a chunk which hasn't been.
+        pending = collections.deque()
+        while True:
+            for task in itertools.islice(tasks, window - len(pending)):
+                pending.append(pool.apply_async(_process_range, [task]))
+            if not pending:
+                break
+            end, count, changes = pending.popleft().get()
+            rows += count
+            updated += len(changes)
+            if not self.args.dry_run:
+                with con:
+                    for id_, updates in changes:
+                        con.update(table, updates, {'id': id_})
+                    if changes:
+                        con.bump_generation()
+                    con.insert('config', {'key': key, 'value': end}, on_conflict='REPLACE')
+            print '%s %s: %d/%d rows (%.1f%%), %d updated, %.0f rows/s' % (
+                name, table, rows, total, 100.0 * rows / max(total, 1),
+                updated, rows / max(time.time() - started_at, 1e-6),
+            )
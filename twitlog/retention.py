@@ -0,0 +1,113 @@
+import json
+
+from .cli import BaseCommand
+
+# Everything younger than the first tier is kept; past each tier's age we
+# only keep the last snapshot per bucket. Override with a JSON list in the
+# config table under "retention.<table>".
+default_policy = [
+    (7, 'day'),
+    (90, 'week'),
+]
+
+buckets = {
+    'hour': '%Y-%m-%d %H',
+    'day': '%Y-%m-%d',
+    'week': '%Y-%W',
+    'month': '%Y-%m',
+}
+
+
+class RetentionCommand(BaseCommand):
+
+    credentials = ()
+
+    def add_arguments(self):
+        self.parser.add_argument('-t', '--table', action='append')
+        self.parser.add_argument('-c', '--chunk-size', type=int, default=10000)
+        self.parser.add_argument('-p', '--vacuum-pages', type=int, default=1000)
+
+    def main(self, args):
+        from .database.schema import snapshot_tables
+        tables = args.table or sorted(snapshot_tables)
+        for table in tables:
+            if table not in snapshot_tables:
+                self.parser.error('not a snapshot table: %s' % table)
+        for table in tables:
+            self.downsample(table)
+
+    def get_policy(self, con, table):
+        row = con.execute('SELECT value FROM config WHERE key = ?', ['retention.' + table]).fetchone()
+        policy = json.loads(row['value']) if row else default_policy
+        policy = sorted((int(age), bucket) for age, bucket in policy)
+        for _, bucket in policy:
+            if bucket not in buckets:
+                raise ValueError('unknown retention bucket', table, bucket)
+        return policy
+
+    def bucket_sql(self, alias, cutoffs):
+        # NULL for anything we keep outright, since NULL never equals itself.
+        cases = []
+        for i, (cutoff, bucket) in enumerate(cutoffs):
+            upper = cutoffs[i + 1][0] if i + 1 < len(cutoffs) else None
+            cases.append("WHEN %s.created_at < '%s'%s THEN '%d ' || strftime('%s', %s.created_at)" % (
+                alias, cutoff,
+                " AND %s.created_at >= '%s'" % (alias, upper) if upper else '',
+                i, buckets[bucket], alias,
+            ))
+        return 'CASE %s END' % ' '.join(cases)
+
+    def downsample(self, table):
+
+        from .database.schema import snapshot_tables
+        key, parent, pointer = snapshot_tables[table]
+
+        con = self.db.connect()
+
+        policy = self.get_policy(con, table)
+        if not policy:
+            return
+        cutoffs = [
+            (con.execute("SELECT datetime('now', ?)", ['-%d days' % age]).fetchone()[0], bucket)
+            for age, bucket in policy
+        ]
+
+        lo, hi = con.execute('SELECT min(id), max(id) FROM %s WHERE created_at < ?' % table, [cutoffs[0][0]]).fetchone()
+        if lo is None:
+            print table, 'nothing to downsample'
+            return
+
+        # Delete every snapshot which has a newer one in the same bucket,
+        # never touching the ones the parent table points to.
+        query = '''
+            DELETE FROM {table} WHERE id IN (
+                SELECT old.id FROM {table} AS old
+                WHERE old.id >= ? AND old.id < ? AND old.created_at < ?
+                AND NOT EXISTS (
+                    SELECT 1 FROM {parent} AS parent
+                    WHERE parent.id = old.{key} AND parent.{pointer} = old.id
+                )
+                AND EXISTS (
+                    SELECT 1 FROM {table} AS new
+                    WHERE new.{key} = old.{key} AND new.id > old.id
+                    AND {new_bucket} = {old_bucket}
+                )
+            )
+        '''.format(
+            table=table, key=key, parent=parent, pointer=pointer,
+            old_bucket=self.bucket_sql('old', cutoffs),
+            new_bucket=self.bucket_sql('new', cutoffs),
+        )
+
+        deleted = 0
+        for start in xrange(lo, hi + 1, self.args.chunk_size):
+            end = min(start + self.args.chunk_size, hi + 1)
+            with con:
+                count = con.execute(query, [start, end, cutoffs[0][0]]).rowcount
+                if count:
+                    con.bump_generation()
+            deleted += count
+            # Hand back what we freed a bit at a time, instead of the long
+            # exclusive lock of a full VACUUM.
+            con.execute('PRAGMA incremental_vacuum(%d)' % self.args.vacuum_pages).fetchall()
+            print table, '%d/%d' % (end - lo, hi - lo + 1), 'deleted', deleted
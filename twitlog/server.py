@@ -0,0 +1,181 @@
+import BaseHTTPServer
+import SocketServer
+import collections
+import json
+import logging
+import re
+import threading
+import urlparse
+
+from .cli import BaseCommand
+
+log = logging.getLogger(__name__)
+
+
+class LRUCache(object):
+
+    # Entries are only good for the generation of the database they were
+    # computed against; once the sync commands bump it, everything goes.
+
+    def __init__(self, size=1000):
+        self.size = size
+        self.generation = None
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, generation):
+        with self._lock:
+            if generation != self.generation:
+                self._data.clear()
+                self.generation = generation
+                return None
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                return None
+            self._data[key] = value
+            return value
+
+    def set(self, key, value, generation):
+        with self._lock:
+            if generation != self.generation:
+                return
+            self._data[key] = value
+            while len(self._data) > self.size:
+                self._data.popitem(last=False)
+
+
+class Queries(object):
+
+    # Each route maps a path pattern onto a method taking the read-only
+    # connection, the path's groups, and the query string.
+    routes = [
+        (r'/followers/count', 'follower_count'),
+        (r'/relationships/changes', 'relationship_changes'),
+        (r'/tweets/(\d+)/metrics', 'tweet_metrics'),
+    ]
+
+    def __init__(self):
+        self.routes = [(re.compile('^%s/?$' % pattern), name) for pattern, name in self.routes]
+
+    def match(self, path):
+        for pattern, name in self.routes:
+            m = pattern.match(path)
+            if m:
+                return getattr(self, name), m.groups()
+        return None, None
+
+    def follower_count(self, con, query):
+        row = con.execute('''
+            SELECT
+                coalesce(sum(rel.is_follower), 0) AS followers,
+                coalesce(sum(rel.is_friend), 0) AS friends
+            FROM users as user
+            JOIN user_relationships as rel
+            ON user.last_relationship_id = rel.id
+        ''').fetchone()
+        return {'followers': row['followers'], 'friends': row['friends']}
+
+    def relationship_changes(self, con, query):
+        since = query.get('since', '1970-01-01')
+        limit = int(query.get('limit', 1000))
+        return [{
+            'id': row['id'],
+            'created_at': row['created_at'],
+            'user_id': row['user_id'],
+            'is_follower': bool(row['is_follower']),
+            'is_friend': bool(row['is_friend']),
+        } for row in con.execute('''
+            SELECT id, created_at, user_id, is_follower, is_friend
+            FROM user_relationships
+            WHERE created_at >= ?
+            ORDER BY id
+            LIMIT ?
+        ''', [since, limit])]
+
+    def tweet_metrics(self, con, query, tweet_id):
+        rows = sorted(con.partitioned('tweet_metrics', '''
+            SELECT id, created_at, json
+            FROM (%s)
+            WHERE tweet_id = ?
+        ''', [int(tweet_id)], since=query.get('since'), until=query.get('until')), key=lambda row: row['id'])
+        return [{
+            'created_at': row['created_at'],
+            'metrics': json.loads(row['json']),
+        } for row in rows]
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+
+        url = urlparse.urlsplit(self.path)
+        query = dict(urlparse.parse_qsl(url.query))
+
+        func, groups = self.server.queries.match(url.path)
+        if func is None:
+            return self.send_json(404, {'error': 'not found'})
+
+        key = (url.path, tuple(sorted(query.iteritems())))
+        con = self.server.db.connect(readonly=True)
+        try:
+            # No transaction here, since archives can't be attached inside
+            # one. Reading the generation first means that at worst we cache
+            # newer results under an older generation, which is then thrown
+            # out on the next request.
+            generation = con.generation()
+            body = self.server.cache.get(key, generation)
+            if body is None:
+                try:
+                    result = func(con, query, *groups)
+                except ValueError as e:
+                    return self.send_json(400, {'error': str(e)})
+                body = json.dumps(result, sort_keys=True)
+                self.server.cache.set(key, body, generation)
+        finally:
+            con.close()
+
+        self.send_body(200, body)
+
+    def send_json(self, code, data):
+        self.send_body(code, json.dumps(data, sort_keys=True))
+
+    def send_body(self, code, body):
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        log.info('%s %s' % (self.address_string(), format % args))
+
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, address, db, cache_size=1000):
+        BaseHTTPServer.HTTPServer.__init__(self, address, Handler)
+        self.db = db
+        self.queries = Queries()
+        self.cache = LRUCache(cache_size)
+
+
+class ServeCommand(BaseCommand):
+
+    credentials = ()
+
+    def add_arguments(self):
+        self.parser.add_argument('-H', '--host', default='127.0.0.1')
+        self.parser.add_argument('-p', '--port', type=int, default=8642)
+        self.parser.add_argument('-c', '--cache-size', type=int, default=1000)
+
+    def main(self, args):
+        logging.basicConfig(level=logging.INFO)
+        server = Server((args.host, args.port), self.db, args.cache_size)
+        print 'Serving %s on http://%s:%d/' % (self.db.path, args.host, args.port)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass